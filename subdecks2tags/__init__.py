@@ -1,14 +1,17 @@
 import logging
 import os
-from aqt import mw
+from collections import defaultdict
+from aqt import gui_hooks, mw
 
 from aqt.qt import QAction, QInputDialog, QDialog, QVBoxLayout, QHBoxLayout, QCheckBox, QComboBox, QPushButton, QLabel, \
     QSpinBox
 from aqt.utils import showInfo, qconnect
 from aqt.progress import ProgressDialog
 from aqt.operations import CollectionOp, OpChanges
-from anki.notes import Note
-from typing import List, Tuple, Set, Dict
+from typing import Any, Callable, Iterable, Iterator, List, Tuple, Set, Dict
+
+# Stay under SQLite's default SQLITE_MAX_VARIABLE_NUMBER (999), leaving room for extra parameters
+SQL_IN_CHUNK_SIZE = 900
 
 
 def get_all_deck_names() -> List[str]:
@@ -16,68 +19,87 @@ def get_all_deck_names() -> List[str]:
     return sorted([d["name"] for d in mw.col.decks.all()])
 
 
-def collect_note_tag_updates(deck_name: str) -> List[Tuple[Note, Set[str]]]:
+def _chunked_in(run: Callable[..., Any], sql: str, ids: List[int], *params: Any) -> List[Any]:
+    """
+    Run sql once per chunk of ids and concatenate the results.
+    The {placeholders} field in sql is filled with one '?' per id; params are bound before the ids.
     """
-    Collect notes and the tags to add based on the subdecks their cards belong to.
+    results: List[Any] = []
+    for i in range(0, len(ids), SQL_IN_CHUNK_SIZE):
+        part = ids[i:i + SQL_IN_CHUNK_SIZE]
+        results.extend(run(sql.format(placeholders=",".join("?" * len(part))), *params, *part) or [])
+    return results
+
+
+def iter_note_tag_updates(deck_name: str) -> Iterator[Tuple[int, Set[str]]]:
+    """
+    Yield note IDs and the tags to add based on the subdecks their cards belong to.
     Each tag corresponds to a subdeck name with spaces replaced by underscores.
+    Notes themselves are never loaded.
     """
-    logging.debug(f"[collect_note_tag_updates] Collecting tag updates for deck: {deck_name}")
+    logging.debug("[iter_note_tag_updates] Collecting tag updates for deck: %s", deck_name)
     col = mw.col
     assert col.db is not None  # for type checker
 
-    # Find all deck IDs whose names start with the specified deck_name (including subdecks)
-    dids = [d["id"] for d in col.decks.all() if d["name"].startswith(deck_name)]
-    if not dids:
-        logging.debug("[collect_note_tag_updates] No matching decks found.")
-        return []
-
-    # Find all card IDs in those decks
-    cids = col.db.list(f"SELECT id FROM cards WHERE did IN ({','.join(['?'] * len(dids))})", *dids)
-    logging.debug(f"[collect_note_tag_updates] Found {len(cids)} cards in selected deck and subdecks.")
-    if not cids:
-        return []
-
-    # Find unique note IDs associated with those cards
-    nids = set(col.db.list(f"SELECT nid FROM cards WHERE id IN ({','.join(['?'] * len(cids))})", *cids))
-    logging.debug(f"[collect_note_tag_updates] Corresponding to {len(nids)} unique notes.")
-
-    updates = []
-    for nid in nids:
-        note = col.get_note(nid)
-        tag_set = set()
-        # For each card of the note, check if it belongs to one of the decks and add corresponding tag
-        for card in note.cards():
-            if card.did in dids:
-                deck = col.decks.get(card.did)
-                if deck:
-                    # Replace spaces with underscores in deck name to form tag, keep '::' intact
-                    tag = deck["name"].replace(" ", "_")  # keep '::'
-                    tag_set.add(tag)
-        if tag_set:
-            updates.append((note, tag_set))
-            logging.debug(f"[collect_note_tag_updates] Note {nid} → {tag_set}")
-    return updates
-
-
-def apply_tags_to_notes(updates: List[Tuple[Note, Set[str]]]) -> None:
+    # Let Anki's backend walk the deck tree to find the selected deck and all of its subdecks
+    head_deck_id = col.decks.id_for_name(deck_name)
+    if head_deck_id is None:
+        logging.debug("[iter_note_tag_updates] No matching decks found.")
+        return
+    dids = col.decks.deck_and_child_ids(head_deck_id)
+    dids_set = set(dids)
+    # Replace spaces with underscores in deck name to form tag, keep '::' intact
+    did_to_tag = {d["id"]: d["name"].replace(" ", "_") for d in col.decks.all() if d["id"] in dids_set}
+
+    # Let SQLite group the distinct deck IDs of each note and join in the note's current tags, so Python
+    # handles one row per note rather than one per card, and already-tagged notes are never loaded
+    rows = _chunked_in(
+        col.db.all,
+        "SELECT c.nid, n.tags, group_concat(DISTINCT c.did) FROM cards c JOIN notes n ON n.id = c.nid "
+        "WHERE c.did IN ({placeholders}) GROUP BY c.nid",
+        dids)
+    if not rows:
+        logging.debug("[iter_note_tag_updates] No cards found in selected deck and subdecks.")
+        return
+
+    # A note only appears more than once when its decks fall into different chunks of deck ids
+    nid_to_dids: Dict[int, Set[int]] = defaultdict(set)
+    existing_tags: Dict[int, str] = {}
+    for nid, tags, note_dids in rows:
+        nid_to_dids[nid].update(int(did) for did in note_dids.split(","))
+        existing_tags[nid] = tags
+    logging.debug("[iter_note_tag_updates] Found %d unique notes in selected deck and subdecks.", len(nid_to_dids))
+
+    for nid, note_dids in nid_to_dids.items():
+        tag_set = {did_to_tag[did] for did in note_dids}
+        existing = {tag.lower() for tag in existing_tags.get(nid, "").split()}
+        needed = {tag for tag in tag_set if tag.lower() not in existing}
+        if needed:
+            yield nid, needed
+
+
+def apply_tags_to_notes(updates: Iterable[Tuple[int, Set[str]]]) -> None:
     """
     Apply collected tags to the corresponding notes in the collection.
     This operation is run in the background to avoid blocking the UI.
     """
-    logging.debug(f"[apply_tags_to_notes] Applying tags to {len(updates)} notes...")
+    logging.debug("[apply_tags_to_notes] Applying tags to notes...")
 
     def op(col) -> OpChanges:
-        # Iterate over each note and add the tags
-        for note, tag_set in updates:
+        # Group note IDs by tag so each tag is added to all of its notes with one backend call,
+        # without loading or saving any Note objects
+        tag_to_nids: Dict[str, List[int]] = defaultdict(list)
+        for nid, tag_set in updates:
             for tag in tag_set:
-                logging.debug(f"[apply_tags_to_notes] Adding tag '{tag}' to note {note.id}")
-                note.add_tag(tag)
-            logging.debug(f"[apply_tags_to_notes] Final tags for note {note.id}: {note.tags}")
-            col.update_note(note)
-            logging.debug(f"[apply_tags_to_notes] Updated note {note.id}")
-        logging.debug("[apply_tags_to_notes] All note updates queued.")
-        logging.debug(f"[apply_tags_to_notes] Updated {len(updates)} notes total.")
-        return OpChanges()
+                tag_to_nids[tag].append(nid)
+
+        # Group every tag write under a single undo step
+        undo_entry = col.add_custom_undo_entry("Tag Notes by Subdeck")
+        for tag, nids in tag_to_nids.items():
+            col.tags.bulk_add(nids, tag)
+            col.merge_undo_entries(undo_entry)
+        logging.debug("[apply_tags_to_notes] Added %d tags to notes.", len(tag_to_nids))
+        return col.merge_undo_entries(undo_entry)
 
     def on_failure(err):
         logging.error(f"[apply_tags_to_notes] Error tagging notes: {err}")
@@ -162,112 +184,98 @@ def reassign_subdeck_cards_to_head(deck_name: str, preserve_levels: int) -> None
         print(f"[DEBUG] [op] Starting flattening operation for deck: {deck_name}, preserve_levels: {preserve_levels}")
         assert col is not None, "[ASSERTION FAILED] Collection object is None"
         head_deck_id = col.decks.id(deck_name)
+        # Snapshot the decks once and index them so later lookups don't go through the deck manager
         all_decks = col.decks.all()
+        by_id = {d["id"]: d for d in all_decks}
+        by_name = {d["name"]: d for d in all_decks}
 
-        # Identify all subdeck IDs that start with the deck_name followed by '::'
-        subdeck_ids = [d["id"] for d in all_decks if d["name"].startswith(deck_name + "::")]
+        # Let Anki's backend walk the deck tree for the subdecks of deck_name; every later pass reuses them
+        subdecks = [by_id[did] for did in col.decks.deck_and_child_ids(head_deck_id) if did != head_deck_id]
+        subdeck_ids = [d["id"] for d in subdecks]
         if not subdeck_ids:
             print("[DEBUG] [reassign_subdeck_cards_to_head] No subdecks found.")
             return OpChanges()
 
-        cids_to_new_did = {}
-        decks_to_process = [(d["name"], d) for d in all_decks if d["name"].startswith(deck_name + "::")]
+        decks_to_process = [(d["name"], d) for d in subdecks]
         preserved_level_msgs: List[str] = []
 
+        # Split each subdeck name once; both the flattening and the cleanup pass reuse the parts and depth
+        # FIXED LOGIC: Calculate subdeck depth correctly (subtract 1 because first part is the main deck)
+        deck_parts = {deck["id"]: subdeck_name.split("::") for subdeck_name, deck in decks_to_process}
+        deck_depth = {subdeck_id: len(parts) - 1 for subdeck_id, parts in deck_parts.items()}
+
+        # Group the subdecks that need flattening by the deck their cards will be moved into
+        new_did_to_source_dids: Dict[int, List[int]] = defaultdict(list)
+        # Many subdecks share a preserved parent, so resolve each target name only once
+        new_did_cache: Dict[str, int] = {}
         for idx, (subdeck_name, deck) in enumerate(decks_to_process):
             subdeck_id = deck["id"]
-            parts = subdeck_name.split("::")
-            assert isinstance(parts, list), f"[ASSERTION FAILED] Expected parts to be a list, got {type(parts)}"
-
-            # FIXED LOGIC: Calculate subdeck depth correctly
-            subdeck_depth = len(parts) - 1  # Subtract 1 because first part is the main deck
+            parts = deck_parts[subdeck_id]
+            subdeck_depth = deck_depth[subdeck_id]
 
             if subdeck_depth <= preserve_levels:
                 # This subdeck should be preserved - skip it
-                print(
-                    f"[DEBUG] [reassign_subdeck_cards_to_head] Preserving deck '{subdeck_name}' (depth {subdeck_depth} <= preserve_levels {preserve_levels})")
                 continue
             else:
                 # This subdeck is too deep - flatten it to the preserved level
                 preserved_parts = parts[:preserve_levels + 1]  # +1 to include the main deck name
                 new_deck_name = "::".join(preserved_parts)
-                new_did = col.decks.id(new_deck_name)
+                new_did = new_did_cache.get(new_deck_name)
+                if new_did is None:
+                    # Only fall back to the deck manager when the target deck has to be created
+                    new_deck = by_name.get(new_deck_name)
+                    new_did = new_deck["id"] if new_deck else col.decks.id(new_deck_name)
+                    new_did_cache[new_deck_name] = new_did
+                new_did_to_source_dids[new_did].append(subdeck_id)
 
-                subdeck_cids = col.db.list("SELECT id FROM cards WHERE did = ?", subdeck_id)
-                print(
-                    f"[DEBUG] [reassign_subdeck_cards_to_head] Flattening '{subdeck_name}' (depth {subdeck_depth}) to '{new_deck_name}'")
-                print(
-                    f"[DEBUG] [reassign_subdeck_cards_to_head] Retrieved {len(subdeck_cids)} cards from subdeck '{subdeck_name}' with id {subdeck_id}")
-
-                for cid in subdeck_cids:
-                    cids_to_new_did[cid] = new_did
-
-        # Rest of the function remains the same...
         print(
-            f"[DEBUG] [reassign_subdeck_cards_to_head] Beginning reassignment to {len(set(cids_to_new_did.values()))} unique decks.")
-        from anki.utils import ids2str
-
-        # Group cards by their new deck ID and process each group
-        new_did_to_cards: Dict[int, List[int]] = {}
-        for cid, new_did in cids_to_new_did.items():
-            if new_did not in new_did_to_cards:
-                new_did_to_cards[new_did] = []
-            new_did_to_cards[new_did].append(cid)
-
-        for new_did, cards in new_did_to_cards.items():
-            print(f"[DEBUG] [reassign_subdeck_cards_to_head] Preparing to reassign cards to new_did: {new_did}")
-            print(f"[DEBUG] [reassign_subdeck_cards_to_head] Cards assigned to this deck: {cards}")
-
-            if not cards:
-                print(f"[DEBUG] [reassign_subdeck_cards_to_head] No cards to reassign for deck {new_did}")
-                continue
-
-            if not isinstance(cards, list) or not all(isinstance(cid, int) for cid in cards):
-                print(f"[ERROR] [reassign_subdeck_cards_to_head] Cards must be a list of ints, got: {cards}")
-                continue
+            f"[DEBUG] [reassign_subdeck_cards_to_head] Beginning reassignment to {len(new_did_to_source_dids)} unique decks.")
+        from anki.utils import int_time
 
+        # Move each group's cards with a single UPDATE so card ids never pass through Python
+        mod = int_time()
+        usn = col.usn()
+        for new_did, source_dids in new_did_to_source_dids.items():
             try:
-                print(
-                    f"[DEBUG] [reassign_subdeck_cards_to_head] Reassigning {len(cards)} cards to '{col.decks.get(new_did)['name']}'")
-                card_ids_str = ids2str(cards)
-                col.db.execute(f"UPDATE cards SET did = ? WHERE id IN {card_ids_str}", new_did)
-                print(f"[DEBUG] [reassign_subdeck_cards_to_head] Successfully reassigned {len(cards)} cards")
+                _chunked_in(col.db.execute, "UPDATE cards SET did = ?, mod = ?, usn = ? WHERE did IN ({placeholders})",
+                            source_dids, new_did, mod, usn)
             except Exception as e:
                 print(
-                    f"[ERROR] [reassign_subdeck_cards_to_head] Failed updating deck for cards: {cards} with error: {e}")
+                    f"[ERROR] [reassign_subdeck_cards_to_head] Failed updating deck for cards in subdecks: {source_dids} with error: {e}")
                 raise
 
         print(f"[DEBUG] [reassign_subdeck_cards_to_head] Finished reassignment of cards.")
 
         # FIXED LOGIC: Only remove decks that were actually flattened
+        # Decks created above sit at the preserved depth, so the snapshot still covers every candidate
         removed_names = []
-        updated_decks = col.decks.all()
 
+        # Only consider removing decks that exceed the preserve level
+        candidates = []
+        for deck in subdecks:
+            if deck_depth[deck["id"]] > preserve_levels:
+                candidates.append((deck["id"], deck["name"]))
+
+        # Look up which candidates still hold cards with one query rather than one count per deck
         empty_subdeck_ids = []
-        for deck in updated_decks:
-            if deck["name"].startswith(deck_name + "::"):
-                subdeck_id = deck["id"]
-                parts = deck["name"].split("::")
-                subdeck_depth = len(parts) - 1
-
-                # Only consider removing decks that exceed the preserve level
-                if subdeck_depth > preserve_levels:
-                    card_count = col.db.scalar("SELECT COUNT(1) FROM cards WHERE did = ?", subdeck_id)
-                    if card_count == 0:
-                        empty_subdeck_ids.append((subdeck_id, deck["name"]))
-
-        # Remove empty subdecks
-        for subdeck_id, subdeck_name in empty_subdeck_ids:
+        if candidates:
+            candidate_ids = [subdeck_id for subdeck_id, _ in candidates]
+            nonempty = set(_chunked_in(col.db.list, "SELECT DISTINCT did FROM cards WHERE did IN ({placeholders})",
+                                       candidate_ids))
+            empty_subdeck_ids = [(subdeck_id, name) for subdeck_id, name in candidates if subdeck_id not in nonempty]
+
+        # Remove all empty subdecks in a single call
+        if empty_subdeck_ids:
             print(
-                f"[DEBUG] [reassign_subdeck_cards_to_head] Attempting to remove empty subdeck '{subdeck_name}' with id {subdeck_id}")
+                f"[DEBUG] [reassign_subdeck_cards_to_head] Attempting to remove {len(empty_subdeck_ids)} empty subdecks")
             try:
-                col.decks.remove([subdeck_id])
-                removed_names.append(subdeck_name)
-                print(f"[DEBUG] [reassign_subdeck_cards_to_head] Successfully removed subdeck '{subdeck_name}'")
+                col.decks.remove([subdeck_id for subdeck_id, _ in empty_subdeck_ids])
+                removed_names = [subdeck_name for _, subdeck_name in empty_subdeck_ids]
+                print(f"[DEBUG] [reassign_subdeck_cards_to_head] Successfully removed {len(removed_names)} subdecks")
             except Exception as e:
-                print(
-                    f"[ERROR] [reassign_subdeck_cards_to_head] Failed to remove subdeck '{subdeck_name}' (id={subdeck_id}): {e}")
-                print(f"[DEBUG] [reassign_subdeck_cards_to_head] Continuing with other removals...")
+                for subdeck_id, subdeck_name in empty_subdeck_ids:
+                    print(
+                        f"[ERROR] [reassign_subdeck_cards_to_head] Failed to remove subdeck '{subdeck_name}' (id={subdeck_id}): {e}")
 
         print(f"[DEBUG] [reassign_subdeck_cards_to_head] Removed {len(removed_names)} empty subdecks.")
 
@@ -329,7 +337,8 @@ def show_subdeck_tool_dialog():
     # Only run tagging if the checkbox is checked
     if dialog.checkbox_tag.isChecked():
         logging.debug("[show_subdeck_tool_dialog] Tagging selected.")
-        updates = collect_note_tag_updates(selected_deck)
+        # Only note IDs and tag sets are gathered here; no notes are loaded
+        updates = list(iter_note_tag_updates(selected_deck))
         if updates:
             apply_tags_to_notes(updates)
         else:
@@ -341,7 +350,12 @@ def show_subdeck_tool_dialog():
         reassign_subdeck_cards_to_head(selected_deck, preserve_levels)
 
 
-# Update toolbar button to open the new dialog
-action = QAction("Subdeck Optimization", mw)
-qconnect(action.triggered, show_subdeck_tool_dialog)
-mw.form.menuTools.addAction(action)
\ No newline at end of file
+def setup_menu_action() -> None:
+    """Add the Subdeck Optimization entry to the Tools menu once the main window is ready."""
+    action = QAction("Subdeck Optimization", mw)
+    qconnect(action.triggered, show_subdeck_tool_dialog)
+    mw.form.menuTools.addAction(action)
+
+
+# Defer creating the menu entry until Anki's main window has finished initialising
+gui_hooks.main_window_did_init.append(setup_menu_action)